@@ -18,6 +18,10 @@ Warnings (SECURITY, PLEASE READ THIS):
     Unless you want people to have access to run commands on YOUR SERVER
     you will definitely want to follow the above advice!
 
+    The built in telnet client skips TinyFugue's /restrict. Only add
+    hosts to 'telnet_allowed_hosts' that anyone on the bot may reach,
+    as allowed hosts can be on your own machine or network.
+
 Notes:
     This requires TinyFugue to work, and by default it expects tinyfugue
     to be installed in PATH and accessible with 'tf'.
@@ -26,13 +30,23 @@ Notes:
     helps allow multiple sessions to run at the same time, but only one
     per room.
 
-    Currently the bot only sends text from the mud every two seconds,
-    and immediately after a command is sent to the mud.
+    Output from the mud is sent as soon as the mud has finished
+    answering: when the prompt after the last command sent shows up, or
+    after half a second without new output. With TinyFugue only the
+    channel's prompt pattern (see 'mudprompt') can spot prompts, as tf
+    does not pass on telnet GA/EOR. The built in telnet client uses
+    GA/EOR as well as the prompt pattern.
 
     There is no color support.
 
-    A simpler implementation could be done with a telnet library, but it
-    would lack some of the functions that tinyfugue provides.
+    Sessions can also use a built in telnet client instead of tinyfugue
+    (see 'mudstart'). It is much lighter, and understands telnet prompts
+    (GA/EOR) and MCCP compression, but has none of tinyfugue's commands,
+    macros or triggers.
+
+    fake_mud.py runs a small local MUD for trying the bot out, and can
+    benchmark memory and latency of the two backends. Run it without
+    arguments for usage.
 
     Currently there are a few extra personal functions I've added to the
     bot that are outside the realistic scope of this project. I plan to
@@ -89,8 +103,14 @@ Chat Commands:
 
         -- help: Lists commands in the chat.
 
-        -- mudstart: Starts a TinyFugue MUD session tied to the chat
-            room. Output from the mud will be fed into only this room.
+        -- mudstart [telnet (host) (port)]: Starts a TinyFugue MUD session
+            tied to the chat room. Output from the mud will be fed into
+            only this room. With 'telnet', connects straight to the MUD
+            at 'host' and 'port' with the built in telnet client instead
+            of TinyFugue. Only permitted roles can use it, and only for
+            public addresses, unless the host is in 'telnet_allowed_hosts'
+            at the top of discordbot.py. Example:
+            '%mudstart telnet discworld.starturtle.net 4242'
 
         -- mudstop: Stops the MUD session in the current room.
 
@@ -104,17 +124,46 @@ Chat Commands:
                 discworld MUD.
             '%md look at cabbage': Send the command 'look at cabbage' to
                 the connected MUD.
+            When several people send commands at once they are taken in
+            turns. Each person can send 20 lines at once, then 5 lines a
+            second, and at most 100 lines can wait per session.
 
         -- / (command): Slightly shorter alias to the 'md' command.
 
-        -- ifstart: (Not fully implemented) Similar to 'mudstart', but
-            for interactive fiction via FrobTads. Not tied to a room
-            session. It's not even tied to a server. To be removed.
-
-        -- ifstop: End the global IF session.
-
-        -- if: Similar to 'md' command, but sends command to the global
-            interactive fiction session.
+        -- mirror [channel]: Show the output of the current room's MUD or
+            IF session in another channel as well, given as a mention or a
+            channel id, possibly in another server. Commands still only work
+            in the room that started the session. You must be able to send
+            messages in that channel, and so must the bot. A channel showing a
+            mirror can't start its own session. A mirror that falls behind
+            skips ahead with a note, and one the bot can no longer post to
+            is removed. With no arguments, lists the mirrors.
+
+        -- unmirror (channel): Stop showing the session in 'channel'.
+
+        -- trigger [dm] (text): Mention you in the room when 'text'
+            appears in the output of the room's MUD or IF session, or send
+            you a direct message instead with 'dm'. Surround the text with
+            slashes to use a regular expression, only permitted roles can do
+            this (see 'perm'), and backreferences are not allowed. Matching
+            ignores case. With no arguments, lists your triggers in the room.
+            Examples:
+            '%trigger Gandalf': Ping when your character's name shows up.
+            '%trigger dm /^\\w+ tells you/': DM on any tell.
+
+        -- untrigger (text): Remove one of your triggers from the room.
+
+        -- ifstart [game]: Similar to 'mudstart', but for interactive
+            fiction via FrobTads. Starts 'game' from the 'textgame'
+            folder in the current room, or lists the available games.
+            Games left idle for half an hour are saved to the 'if_saves'
+            folder and resumed by the next 'if' command in the room.
+
+        -- ifstop: End the IF game in the current room, including a
+            saved idle game.
+
+        -- if: Similar to 'md' command, but sends command to the IF
+            game in the current room. 'esc' sends the escape key.
 
         -- i: Alias for 'if' command.
 
@@ -201,6 +250,19 @@ Chat Commands:
         -- unblacklist (role): Remove the discord role 'role' from the
             bot blacklist.
 
+        -- attachlimit [kb] [messages] [gzip]: Output from a MUD or IF
+            session larger than 'kb' kilobytes or 'messages' messages is
+            sent as a short preview and one attached file, gzip
+            compressed if 'gzip' is given. Defaults to 8 KB or 4
+            messages, uncompressed. Use 'default' to reset, or no
+            arguments to show the current limits.
+
+        -- mudprompt [pattern]: Set a regular expression matching the
+            MUD's prompt for this channel, so output is sent as soon as
+            the prompt shows up. Use 'none' to clear it, or no pattern
+            to show the current one. Example:
+            '%mudprompt ^\\d+hp \\d+mp >': Matches '120hp 45mp >'.
+
 TODO:
     Clean up extra functionality of the bot that is outside the scope
     of the project (interactive fiction games, random emotes, etc).
@@ -214,9 +276,7 @@ TODO:
     Test if the bot can stay active for weeks at a time or if it
     occasionally disconnects, and find a fix for that if it does.
 
-    Possibly improve telnet output, truncate large output files,
-    or move away from using files entirely. If keeping the same
-    output system, automatically create the folder for the files.
+    Possibly improve telnet output.
 
     Add functionality for sending multiple commands at once. Newline
     possibly.
@@ -230,24 +290,254 @@ Bugs:
 """
 
 import asyncio
+import codecs
+import collections
+import gzip
+import io
+import ipaddress
 import json
 import os
 import boto3
 import random
 import re
+import socket
 import subprocess
-import threading
-import queue
+import zlib
 import discord
 
 srand = random.SystemRandom()
 script_path = os.path.dirname(os.path.abspath(__file__))
-with open(os.path.join(script_path, "bot_key")) as f:
-    my_key = f.readline().replace("\n", "")
-    ai_access_id = f.readline().replace("\n", "")
-    ai_access_key = f.readline().replace("\n", "")
 
 tiny_fugue_path = "tf"
+mud_quiet_period = 0.5
+mud_response_timeout = 5
+telnet_prompt_mark = b"\xff\xf9" # IAC GA, TelnetClient turns GA and EOR into it, tf passes neither on
+input_queue_limit = 100
+user_line_rate = 5
+user_line_burst = 20
+attach_size_kb = 8
+attach_chunk_limit = 4
+output_preview_size = 600
+trigger_user_limit = 25
+trigger_hit_limit = 5
+trigger_line_limit = 200
+trigger_pattern_limit = 100
+subscriber_queue_limit = 20
+telnet_connect_timeout = 15
+telnet_allowed_hosts = [] # Hosts anyone may telnet to, private addresses included, e.g. "localhost" for fake_mud.py
+frob_path = "frob"
+if_games_path = os.path.join(script_path, "textgame")
+if_saves_path = os.path.join(script_path, "if_saves")
+if_idle_timeout = 30 * 60
+if_prompt_re = re.compile(r"^\s*>\s*$")
+
+class TriggerMatcher:
+    # Aho-Corasick automaton over the literal triggers plus one combined
+    # regex over the pattern triggers, so each line is scanned once no
+    # matter how many triggers a channel has. Matching ignores case.
+    def __init__(self, triggers):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        self.patterns = []
+        for trigger in triggers:
+            if not trigger['regex']:
+                self.add_literal(trigger['pattern'].lower(), trigger)
+            elif self.check_pattern(trigger['pattern']) is None:
+                self.patterns.append(trigger)
+        self.build()
+        self.combined = self.scanner = None
+        if self.patterns:
+            # 'combined' finds the next place any pattern matches, then
+            # 'scanner' tries every pattern as an optional lookahead at that
+            # place and reports them all through its named groups.
+            self.combined = re.compile("|".join(
+                "(?:{})".format(t['pattern']) for t in self.patterns), re.I)
+            self.scanner = re.compile("".join(
+                "(?:(?=(?P<_t{}>{})))?".format(i, t['pattern']) for i, t in enumerate(self.patterns)), re.I)
+
+    @staticmethod
+    def check_pattern(pattern):
+        # Returns why a trigger pattern can't be used, or None. Patterns
+        # are combined into one regex, so numbered backreferences and
+        # conditionals would point at the wrong groups, and two patterns
+        # naming a group the same would not compile together.
+        if len(pattern) > trigger_pattern_limit:
+            return "Trigger patterns are limited to {} characters.".format(trigger_pattern_limit)
+        if re.search(r"(?<!\\)(?:\\\\)*\\[1-9]|\(\?\(", pattern):
+            return "Backreferences and conditionals are not supported in triggers."
+        if re.search(r"\(\?P[<=]", pattern):
+            return "Named groups are not supported in triggers, use (?:...) instead."
+        try:
+            re.compile("(?:(?=(?P<_t0>{})))?".format(pattern), re.I)
+        except re.error as e:
+            return "Invalid trigger pattern: " + str(e)
+        return None
+
+    def add_literal(self, text, trigger):
+        state = 0
+        for ch in text:
+            if ch not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append([])
+                self.goto[state][ch] = len(self.goto) - 1
+            state = self.goto[state][ch]
+        self.out[state].append(trigger)
+
+    def build(self):
+        pending = collections.deque(self.goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for ch, child in self.goto[state].items():
+                pending.append(child)
+                fallback = self.fail[state]
+                while fallback and ch not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(ch, 0)
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+
+    def match(self, line):
+        found = []
+        state = 0
+        for ch in line.lower():
+            while state and ch not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(ch, 0)
+            if self.out[state]:
+                found.extend(t for t in self.out[state] if t not in found)
+        if self.combined:
+            seen = set()
+            m = self.combined.search(line)
+            while m and len(seen) < len(self.patterns):
+                groups = self.scanner.match(line, m.start()).groupdict()
+                seen.update(int(name[2:]) for name, value in groups.items()
+                            if value is not None and name.startswith("_t"))
+                m = self.combined.search(line, m.start() + 1)
+            found.extend(self.patterns[i] for i in sorted(seen))
+        return found
+
+class TelnetClient:
+    # In-process alternative to running TinyFugue for a MUD session. It
+    # looks enough like an asyncio subprocess for the session code:
+    # output is read from stdout, commands are written to stdin. Telnet
+    # negotiation and MCCP are handled here, and GA/EOR prompts come out
+    # as IAC GA (telnet_prompt_mark) for the reader to count.
+    IAC, DONT, DO, WONT, WILL, SB, GA, SE, EOR = 255, 254, 253, 252, 251, 250, 249, 240, 239
+    OPT_ECHO, OPT_SGA, OPT_EOR, OPT_MCCP2 = 1, 3, 25, 86
+    accepted = (OPT_ECHO, OPT_SGA, OPT_EOR, OPT_MCCP2)
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.stdin = self.stdout = self
+        self.pending = b""
+        self.inflate = None
+        self.replies = set()
+
+    @classmethod
+    async def connect(cls, host, port):
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port), telnet_connect_timeout)
+        return cls(reader, writer)
+
+    @staticmethod
+    async def resolve_public(host, port):
+        # First address of host that is on the public internet, so a
+        # session can't reach the bot's own machine or network. Connect to
+        # the address itself so the name can't resolve elsewhere later.
+        infos = await asyncio.wait_for(asyncio.get_running_loop().getaddrinfo(
+            host, port, type=socket.SOCK_STREAM), telnet_connect_timeout)
+        for family, kind, proto, name, address in infos:
+            if ipaddress.ip_address(address[0].split("%")[0]).is_global:
+                return address[0]
+        return None
+
+    async def read(self, n=4096):
+        while True:
+            data = await self.reader.read(n)
+            if not data:
+                return b""
+            text = self.feed(data)
+            if text:
+                return text
+
+    def feed(self, data):
+        out = bytearray()
+        while data:
+            if self.inflate:
+                raw = self.inflate.decompress(data)
+                data = b""
+                if self.inflate.eof:
+                    data = self.inflate.unused_data
+                    self.inflate = None
+            else:
+                raw, data = data, b""
+            data = self.parse(raw, out) + data
+        return bytes(out)
+
+    def parse(self, raw, out):
+        # Returns whatever follows the start of compression, which has
+        # to go through the decompressor first.
+        buf = self.pending + raw
+        self.pending = b""
+        i = 0
+        while i < len(buf):
+            end = buf.find(b"\xff", i)
+            if end == -1:
+                end = len(buf)
+            out += buf[i:end].translate(None, b"\r\x00")
+            i = end
+            if i >= len(buf):
+                break
+            if i + 1 >= len(buf):
+                self.pending = buf[i:]
+                break
+            cmd = buf[i + 1]
+            if cmd in (self.GA, self.EOR):
+                out += bytes((self.IAC, self.GA))
+                i += 2
+            elif cmd in (self.DO, self.DONT, self.WILL, self.WONT):
+                if i + 2 >= len(buf):
+                    self.pending = buf[i:]
+                    break
+                self.negotiate(cmd, buf[i + 2])
+                i += 3
+            elif cmd == self.SB:
+                end = buf.find(bytes((self.IAC, self.SE)), i + 2)
+                if end == -1:
+                    self.pending = buf[i:]
+                    break
+                option = buf[i + 2] if end > i + 2 else None
+                i = end + 2
+                if option == self.OPT_MCCP2:
+                    self.inflate = zlib.decompressobj()
+                    return buf[i:]
+            else:
+                i += 2 # IAC IAC (a 0xff byte, never valid UTF-8) and other commands.
+        return b""
+
+    def negotiate(self, cmd, option):
+        if cmd == self.WILL:
+            reply = self.DO if option in self.accepted else self.DONT
+        elif cmd == self.DO:
+            reply = self.WONT
+        else:
+            return
+        if (reply, option) in self.replies:
+            return
+        self.replies.add((reply, option))
+        self.writer.write(bytes((self.IAC, reply, option)))
+
+    def write(self, data):
+        data = data.replace(b"\xff", b"\xff\xff").replace(b"\n", b"\r\n")
+        self.writer.write(data)
+
+    async def drain(self):
+        await self.writer.drain()
+
+    def terminate(self):
+        self.writer.close()
 
 class BotApp(discord.Client):
     def __init__(self, intents):
@@ -255,11 +545,17 @@ class BotApp(discord.Client):
         self.mycmds = self.init_commands()
         self.restricted = self.init_restricted()
         self.game_sessions = {}
+        self.if_sessions = {}
+        self.if_locks = {}
+        self.trigger_matchers = {}
         self.bot_settings = self.load_settings()
         if not self.bot_settings:
             self.bot_settings = self.create_default_settings()
         self.my_messages = []
         
+    async def setup_hook(self):
+        asyncio.create_task(self.check_if_sessions())
+
     async def on_ready(self):
         print(self.user.id)
 
@@ -429,49 +725,174 @@ class BotApp(discord.Client):
 
     async def start_if(self, message_data):
         rm = message_data.channel
-        self.if_queue = queue.Queue()
-        f = open("stdout", "w+")
-        f2 = open("stdout", "r")
-        self.sp = subprocess.Popen(["frob", "-i", "plain", "textgame/1893.gam"],
-                stdin=subprocess.PIPE, stdout=f, stderr=subprocess.STDOUT)
-        self.if_thread = threading.Thread(target=self.read_if_output, args=(self.sp,f2))
-        self.if_thread.start()
+        async with self.get_if_lock(rm.id):
+            session = self.if_sessions.get(rm.id)
+            if session and session['reader'].done(): # Ended, make way for a new game.
+                await self.evict_if_session(session)
+            if rm.id in self.if_sessions or str(rm.id) in self.bot_settings['if_saves']:
+                await rm.send("IF game already started in this channel. Use ifstop to end it.")
+                return
+            if await self.refuse_if_mirror(rm):
+                return
+            games = self.list_if_games()
+            termslist = message_data.content.split(" ")
+            if len(termslist) < 2 or termslist[1] not in games:
+                if not games:
+                    await rm.send("No IF games found.")
+                else:
+                    await rm.send("Usage: %ifstart [game]\n```\n" + ", ".join(games) + "```")
+                return
+            if not await self.open_if_session(rm, termslist[1]):
+                await rm.send("Unable to start IF game.")
+                return
         await rm.send("Starting IF game.")
-        await self.send_if_output(rm)
 
 
     async def kill_if(self, message_data):
-        self.sp.terminate()
-        await message_data.channel.send("Killing IF game.")
+        rm = message_data.channel
+        async with self.get_if_lock(rm.id):
+            session = self.if_sessions.pop(rm.id, None)
+            if session:
+                self.stop_session_process(session)
+            saved = self.forget_if_save(rm.id)
+        if session or saved:
+            await rm.send("Killing IF game.")
+        else:
+            await rm.send("No IF session found for this channel.")
 
 
     async def send_if_command(self, message_data):
         rm = message_data.channel
         line = " ".join(message_data.content.split(" ")[1:]) + "\n"
         if line == "esc\n":
-            self.sp.stdin.write(b"\x1b")
+            data = b"\x1b"
+        else:
+            data = line.encode("utf-8")
+        # The lock keeps starting, resuming, evicting and stopping the
+        # channel's game one at a time, and input is queued while holding
+        # it so an eviction never drops it.
+        async with self.get_if_lock(rm.id):
+            session = self.if_sessions.get(rm.id)
+            if not session:
+                game = self.bot_settings['if_saves'].get(str(rm.id))
+                if not game:
+                    await rm.send("No IF session found for this channel. Use ifstart.")
+                    return
+                session = await self.open_if_session(rm, game, resume=True)
+                if not session:
+                    await rm.send("Unable to resume IF game.")
+                    return
+                await rm.send("Resuming IF game.")
+            if session['reader'].done():
+                await rm.send("The IF game has ended. Use ifstop.")
+                return
+            session['last_input'] = asyncio.get_running_loop().time()
+            queued = self.queue_session_input(session, message_data.author.id, [data])
+        if not queued:
+            await rm.send("Too many commands waiting for this game, try again shortly.")
+
+
+    async def open_if_session(self, rm, game, resume=False):
+        args = [frob_path, "-i", "plain"]
+        if resume:
+            args += ["-r", self.get_if_save_path(rm.id)]
+        args.append(os.path.join(if_games_path, game))
+        session = {
+            'channel': rm,
+            'game': game,
+            'prompt_re': if_prompt_re,
+            'send_output': self.send_if_output,
+            'last_input': asyncio.get_running_loop().time(),
+            }
+        try:
+            await self.start_session_process(session, args, stderr=subprocess.STDOUT)
+        except OSError as e:
+            print(e)
+            return None
+        self.if_sessions[rm.id] = session
+        return session
+
+    async def evict_if_session(self, session):
+        # Save the game through the interpreter's own save command, then
+        # drop the process. The next %if in the channel restores it. The
+        # caller holds the channel's IF lock.
+        channel_id = session['channel'].id
+        if session['reader'].done():
+            # The game ended, a save it was resumed from is finished too.
+            self.stop_session_process(session)
+            self.if_sessions.pop(channel_id, None)
+            self.forget_if_save(channel_id)
+            return True
+        save_path = self.get_if_save_path(channel_id)
+        os.makedirs(if_saves_path, exist_ok=True)
+        try:
+            os.remove(save_path)
+        except FileNotFoundError:
+            pass
+        session['pump'].cancel()
+        session['writer'].cancel()
+        if not await self.write_session_input(session, b"save\n" + save_path.encode("utf-8") + b"\n"):
+            return False
+        for i in range(20):
+            await asyncio.sleep(0.25)
+            if os.path.exists(save_path):
+                break
         else:
-            self.sp.stdin.write(line.encode("utf-8"))
-        self.sp.stdin.flush()
-        await asyncio.sleep(0.2)
-        await self.send_if_output(rm)
+            print("IF save for " + str(channel_id) + " failed.")
+            session['pump'] = asyncio.create_task(self.pump_session_output(session))
+            session['writer'] = asyncio.create_task(self.drain_session_input(session))
+            return False
+        await asyncio.sleep(0.25)
+        self.stop_session_process(session)
+        self.if_sessions.pop(channel_id, None)
+        self.bot_settings['if_saves'][str(channel_id)] = session['game']
+        self.save_settings()
+        return True
 
+    async def check_if_sessions(self):
+        await self.wait_until_ready()
+        while not self.is_closed():
+            for channel_id in list(self.if_sessions):
+                async with self.get_if_lock(channel_id):
+                    session = self.if_sessions.get(channel_id)
+                    now = asyncio.get_running_loop().time()
+                    if (not session or now - session['last_input'] < if_idle_timeout
+                            or session['input_count']):
+                        continue
+                    try:
+                        await self.evict_if_session(session)
+                    except Exception as e:
+                        print(e)
+            await asyncio.sleep(60)
 
-    def read_if_output(self, process, stdout):
-        while True:
-            if process.poll() is not None:
-                break
-            line = stdout.readline()
-            if line:
-                self.if_queue.put(line)
-        print("Thread dead")
-
-    async def send_if_output(self, rm):
-        result = []
-        while not self.if_queue.empty():
-            result.append(self.if_queue.get())
+    def get_if_lock(self, channel_id):
+        return self.if_locks.setdefault(channel_id, asyncio.Lock())
+
+    def list_if_games(self):
+        try:
+            return sorted(x for x in os.listdir(if_games_path)
+                          if os.path.isfile(os.path.join(if_games_path, x)))
+        except OSError:
+            return []
+
+    def get_if_save_path(self, channel_id):
+        return os.path.join(if_saves_path, str(channel_id) + ".sav")
+
+    def forget_if_save(self, channel_id):
+        # A resumed game keeps its save until it is saved again or ends,
+        # so a restart of the bot meanwhile can still resume it.
+        game = self.bot_settings['if_saves'].pop(str(channel_id), None)
+        if game:
+            self.save_settings()
+            try:
+                os.remove(self.get_if_save_path(channel_id))
+            except OSError as e:
+                print(e)
+        return game
+
+    async def send_if_output(self, session):
+        result = self.take_session_output(session)
         if len(result) == 0 or not "".join(result).strip():
-            print("IF trying to send no output.")
             return
         for i, line in enumerate(result):
             if len(line) > 1 and line[-1:] == "\n":
@@ -479,48 +900,68 @@ class BotApp(discord.Client):
         return_string = "".join(result)
         while return_string.find("\n\n\n") != -1:
             return_string = return_string.replace("\n\n\n", "\n\n")
-        while len(return_string) > 1700:
-            await rm.send("```\n" + return_string[0:1700] + "```")
-            return_string = return_string[1700:]
-        await rm.send("```\n" + return_string + "```")
+        rm = session['channel']
+        self.publish_output(session, self.render_output(rm.id, return_string))
 
     def escape_ansi(self, line):
             ansi_escape = re.compile(r'(?:\x1B[@-_]|[\x80-\x9F])[0-?]*[ -/]*[@-~]')
             return ansi_escape.sub('', line)
 
     async def start_mud(self, message_data):
-        session = self.game_sessions.get(message_data.channel.id)
-        if session:
-            await message_data.channel.send("Session already started in this channel.")
-            return
-        self.game_sessions[message_data.channel.id] = session = {}
-        session['queue'] = queue.Queue()
-        session['stdout'] = open(os.path.join(script_path, "sessions", str(message_data.channel.id)), "w+")
-        session['stdout2'] = open(os.path.join(script_path, "sessions", str(message_data.channel.id)), "r")
-        session['sp'] = subprocess.Popen(
-            [tiny_fugue_path, "-v"], stdin=subprocess.PIPE, stdout=session['stdout']
-            )
-        session['thread'] = threading.Thread(target=self.read_mud_output, args=(session,))
-        session['thread'].start()
-        session['channel'] = message_data.channel
-        await session['channel'].send("Starting MUD.")
-        await self.send_mud_output(session)
-
-
-    async def kill_mud(self, message_data):
-        session = self.game_sessions.get(message_data.channel.id)
-        if session:
+        rm = message_data.channel
+        if rm.id in self.game_sessions:
+            await rm.send("Session already started in this channel.")
+            return
+        if await self.refuse_if_mirror(rm):
+            return
+        termslist = message_data.content.strip().split(" ")
+        backend = termslist[1].lower() if len(termslist) > 1 else "tf"
+        if (backend == "telnet" and len(termslist) == 4 and termslist[3].isdecimal()
+                and 1 <= int(termslist[3]) <= 65535):
+            host, port = termslist[2], int(termslist[3])
+            # tf can be held to its own worlds with /restrict world, the
+            # telnet client reaches whatever it is given.
+            trusted = host.lower() in telnet_allowed_hosts
+            if not trusted and not self.has_permission(message_data):
+                await rm.send("Only permitted roles can connect to hosts outside the allowed list.")
+                return
+        elif backend != "tf" or len(termslist) > 2:
+            await rm.send("Usage: %mudstart [telnet (host) (port)]")
+            return
+        session = {}
+        session['channel'] = rm
+        session['prompt_re'] = self.get_mud_prompt(rm.id)
+        session['send_output'] = self.send_mud_output
+        await rm.send("Starting MUD.")
+        if backend == "telnet":
             try:
-                session['sp'].terminate()
-            except Exception as e:
+                address = host if trusted else await TelnetClient.resolve_public(host, port)
+                if address is None:
+                    await rm.send("{} is not a public address.".format(host))
+                    return
+                self.open_session(session, await TelnetClient.connect(address, port))
+            except (OSError, asyncio.TimeoutError) as e:
                 print(e)
-
+                await rm.send("Unable to connect to {} {}.".format(host, port))
+                return
+        else:
             try:
-                session['stdout'].close()
-                session['stdout2'].close()
-            except Exception as e:
+                await self.start_session_process(session, [tiny_fugue_path, "-v"])
+            except OSError as e:
                 print(e)
+                await rm.send("Unable to start TinyFugue.")
+                return
+        if rm.id in self.game_sessions: # Started by someone else meanwhile.
+            self.stop_session_process(session)
+            await rm.send("Session already started in this channel.")
+            return
+        self.game_sessions[rm.id] = session
+
 
+    async def kill_mud(self, message_data):
+        session = self.game_sessions.get(message_data.channel.id)
+        if session:
+            self.stop_session_process(session)
             self.game_sessions.pop(message_data.channel.id)
             await message_data.channel.send("Killing MUD.")
         else:
@@ -530,58 +971,640 @@ class BotApp(discord.Client):
     async def send_mud_command(self, message_data):
         session = self.game_sessions.get(message_data.channel.id)
         if session:
+            if session['reader'].done():
+                await message_data.channel.send("The MUD session has ended. Use mudstop.")
+                return
             lines = " ".join(message_data.content.split(" ")[1:]).split("\n")
-            for line in lines:
-                line = line + "\n"
-                session['sp'].stdin.write(line.encode("utf-8"))
-                session['sp'].stdin.flush()
-                await asyncio.sleep(0.2)
-            await self.send_mud_output(session)
+            data = [(line + "\n").encode("utf-8") for line in lines]
+            if not self.queue_session_input(session, message_data.author.id, data):
+                await message_data.channel.send("Too many commands waiting for this session, try again shortly.")
         else:
             await message_data.channel.send("No session found for this channel.")
 
 
-    def read_mud_output(self, session):
+    async def start_session_process(self, session, args, stderr=None):
+        sp = await asyncio.create_subprocess_exec(
+            *args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr
+            )
+        self.open_session(session, sp)
+
+    def open_session(self, session, sp):
+        # Shared by MUD and IF sessions. 'sp' is a process or anything
+        # with the same stdin/stdout/terminate interface (TelnetClient).
+        # The caller fills in 'channel', 'prompt_re' and 'send_output'
+        # before opening.
+        session['buffer'] = []
+        session['partial'] = ""
+        session['partial_prompt'] = False
+        session['prompt_from'] = 0
+        session['awaiting_prompts'] = 0
+        session['decoder'] = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        session['output_ready'] = asyncio.Event()
+        session['prompt_seen'] = asyncio.Event()
+        session['trigger_hits'] = []
+        session['trigger_dms'] = asyncio.Queue(maxsize=subscriber_queue_limit)
+        session['input'] = {}
+        session['input_order'] = collections.deque()
+        session['input_count'] = 0
+        session['input_ready'] = asyncio.Event()
+        session['rates'] = {}
+        session['sp'] = sp
+        session['reader'] = asyncio.create_task(self.read_session_output(session))
+        session['pump'] = asyncio.create_task(self.pump_session_output(session))
+        session['writer'] = asyncio.create_task(self.drain_session_input(session))
+        session['dm_sender'] = asyncio.create_task(self.deliver_trigger_dms(session))
+        session['subscribers'] = {}
+        self.add_subscriber(session, session['channel'])
+
+    def stop_session_process(self, session):
+        try:
+            session['sp'].terminate()
+        except Exception as e:
+            print(e)
+        session['reader'].cancel()
+        session['pump'].cancel()
+        session['writer'].cancel()
+        session['dm_sender'].cancel()
+        for sub in session['subscribers'].values():
+            sub['task'].cancel()
+
+    def add_subscriber(self, session, rm):
+        # Every channel showing the session, the primary one included,
+        # gets its own queue and sender so a slow channel only holds
+        # itself up. Only mirrors have a bounded queue, the players' own
+        # channel never loses output.
+        primary = rm.id == session['channel'].id
+        sub = {'channel': rm, 'skipped': 0,
+               'queue': asyncio.Queue(maxsize=0 if primary else subscriber_queue_limit)}
+        sub['task'] = asyncio.create_task(self.deliver_subscriber_output(session, sub))
+        session['subscribers'][rm.id] = sub
+
+    def remove_subscriber(self, session, channel_id):
+        sub = session['subscribers'].pop(channel_id)
+        sub['task'].cancel()
+
+    def publish_output(self, session, messages, channel_id=None):
+        # Output is rendered once and the same messages are queued for
+        # every subscriber, or only for channel_id if given.
+        for sub in session['subscribers'].values():
+            if channel_id is not None and sub['channel'].id != channel_id:
+                continue
+            if sub['queue'].full():
+                sub['queue'].get_nowait() # Drop the oldest, let a slow mirror catch up.
+                sub['skipped'] += 1
+            sub['queue'].put_nowait(messages)
+
+    async def deliver_subscriber_output(self, session, sub):
+        rm = sub['channel']
+        while True:
+            messages = await sub['queue'].get()
+            if sub['skipped']:
+                note = "({} updates skipped, this channel fell behind.)".format(sub['skipped'])
+                messages = [(note, None, None)] + messages
+                sub['skipped'] = 0
+            try:
+                await self.deliver_output(rm, messages)
+            except (discord.NotFound, discord.Forbidden) as e:
+                # The mirror's channel is gone or closed to the bot, stop
+                # sending there. The primary channel is left to its session.
+                print(e)
+                if rm.id != session['channel'].id and session['subscribers'].get(rm.id) is sub:
+                    session['subscribers'].pop(rm.id)
+                    print("Mirror to " + str(rm.id) + " removed.")
+                    return
+            except Exception as e:
+                print(e)
+
+    def queue_session_input(self, session, user, data):
+        # Each user gets their own queue so their lines stay in order,
+        # the writer task takes turns between users.
+        if session['input_count'] + len(data) > input_queue_limit:
+            return False
+        if user not in session['input']:
+            session['input'][user] = collections.deque()
+            session['input_order'].append(user)
+        session['input'][user].extend(data)
+        session['input_count'] += len(data)
+        session['input_ready'].set()
+        return True
+
+    def take_session_input(self, session, now):
+        # Round robin, one line per user per turn while they have rate
+        # tokens left. Returns the lines to write and, if users are
+        # waiting on the rate limit, how long until the next token.
+        order = session['input_order']
+        batch = []
+        blocked = []
+        wait = None
+        while order:
+            user = order.popleft()
+            tokens, stamp = session['rates'].get(user, (user_line_burst, now))
+            tokens = min(user_line_burst, tokens + (now - stamp) * user_line_rate)
+            if tokens < 1:
+                session['rates'][user] = (tokens, now)
+                needed = (1 - tokens) / user_line_rate
+                wait = needed if wait is None else min(wait, needed)
+                blocked.append(user)
+                continue
+            lines = session['input'][user]
+            batch.append(lines.popleft())
+            session['input_count'] -= 1
+            session['rates'][user] = (tokens - 1, now)
+            if lines:
+                order.append(user)
+            else:
+                session['input'].pop(user)
+        order.extend(blocked)
+        return batch, wait
+
+    async def drain_session_input(self, session):
+        # The only task writing to the process, so input from different
+        # users is never interleaved mid-write.
+        loop = asyncio.get_running_loop()
+        while True:
+            await session['input_ready'].wait()
+            batch, wait = self.take_session_input(session, loop.time())
+            # Each line gets its own prompt back, output is held until
+            # the prompt for the last of them.
+            session['awaiting_prompts'] += len(batch)
+            if batch and not await self.write_session_input(session, b"".join(batch)):
+                print("Input for " + str(session['channel'].id) + " dropped, process ended.")
+                session['input'].clear()
+                session['input_order'].clear()
+                session['input_count'] = 0
+            if not session['input_order']:
+                session['input_ready'].clear()
+            elif not batch:
+                await asyncio.sleep(wait)
+
+    async def write_session_input(self, session, data):
+        try:
+            session['sp'].stdin.write(data)
+            await session['sp'].stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            return False
+        return True
+
+    async def read_session_output(self, session):
         while True:
-            if session['sp'].poll() is not None:
+            try:
+                data = await session['sp'].stdout.read(4096)
+            except (OSError, zlib.error) as e: # Reset connection or bad MCCP data, same as EOF.
+                print(e)
+                break
+            if not data:
                 break
+            matcher = self.get_trigger_matcher(session['channel'].id)
+            # A telnet mark ends a prompt on the unfinished line. If the
+            # prompt pattern already counted it, it is still the one
+            # prompt, and the pattern only looks past the mark afterwards.
+            prompts = 0
+            for n, segment in enumerate(data.split(telnet_prompt_mark)):
+                if n:
+                    if not session['partial_prompt']:
+                        prompts += 1
+                    session['partial_prompt'] = False
+                    session['prompt_from'] = len(session['partial'])
+                prompts += self.add_session_text(session, session['decoder'].decode(segment), matcher)
+            if prompts:
+                session['awaiting_prompts'] = max(0, session['awaiting_prompts'] - prompts)
+                if not session['awaiting_prompts']:
+                    session['prompt_seen'].set()
+            session['last_output'] = asyncio.get_running_loop().time()
+            session['output_ready'].set()
+        session['partial'] += session['decoder'].decode(b"", final=True)
+        session['prompt_seen'].set()
+        session['output_ready'].set()
+        print("Reader for " + str(session['channel'].id) + " stopped.")
+
+    def add_session_text(self, session, text, matcher):
+        # Buffers the text by line and returns how many prompts the
+        # session's prompt pattern found in it.
+        ioctl_error = '% TIOCGWINSZ ioctl: Inappropriate ioctl for device'
+        text = session['partial'] + text
+        *lines, session['partial'] = text.split("\n")
+        for line in lines:
+            if ioctl_error not in line:
+                session['buffer'].append(line + "\n")
+                if matcher:
+                    clean_line = self.escape_ansi(line).strip()
+                    hits = matcher.match(clean_line)
+                    if hits:
+                        session['trigger_hits'].append((hits, clean_line))
+        # An unfinished line already counted as a prompt isn't counted
+        # again when the rest of it arrives. prompt_from skips the part of
+        # the line before the last telnet mark.
+        prompts = 0
+        counted = session['partial_prompt']
+        for n, line in enumerate(lines):
+            if n == 0:
+                line = line[session['prompt_from']:]
+            if not (n == 0 and counted) and self.is_prompt(session, line):
+                prompts += 1
+        if lines:
+            counted = False
+            session['prompt_from'] = 0
+        if not counted and self.is_prompt(session, session['partial'][session['prompt_from']:]):
+            prompts += 1
+            counted = True
+        session['partial_prompt'] = counted
+        return prompts
+
+    async def pump_session_output(self, session):
+        # A response ends when the prompt for the last line sent is seen
+        # (telnet GA/EOR from TelnetClient, or the session's prompt
+        # pattern), when no output has arrived for mud_quiet_period
+        # seconds, or after mud_response_timeout seconds of continuous
+        # output.
+        loop = asyncio.get_running_loop()
+        while True:
+            await session['output_ready'].wait()
+            deadline = loop.time() + mud_response_timeout
+            while not session['prompt_seen'].is_set():
+                now = loop.time()
+                quiet = session['last_output'] + mud_quiet_period - now
+                if quiet <= 0 or now >= deadline:
+                    break
+                try:
+                    await asyncio.wait_for(session['prompt_seen'].wait(), min(quiet, deadline - now))
+                except asyncio.TimeoutError:
+                    pass
+            if not session['prompt_seen'].is_set():
+                session['awaiting_prompts'] = 0 # Some prompts never came, don't wait on them later.
+            session['prompt_seen'].clear()
+            session['output_ready'].clear()
             try:
-                line = session['stdout2'].readline()
-            except ValueError:
+                await session['send_output'](session)
+                self.send_trigger_hits(session)
+            except Exception as e:
+                print(e)
+            if session['reader'].done() and not session['output_ready'].is_set():
                 break
-            if line:
-                ioctl_error = '% TIOCGWINSZ ioctl: Inappropriate ioctl for device'
-                if ioctl_error not in line:
-                    session['queue'].put(line)
-        print("Thread for " + str(session['channel'].id) + " killed.")
+
+    def is_prompt(self, session, line):
+        if not line or not session['prompt_re']:
+            return False
+        return session['prompt_re'].search(self.escape_ansi(line)) is not None
+
+    def take_session_output(self, session):
+        result = session['buffer']
+        session['buffer'] = []
+        if session['partial']:
+            result.append(session['partial'])
+            session['partial'] = ""
+            session['partial_prompt'] = False
+            session['prompt_from'] = 0
+        return result
 
     async def send_mud_output(self, session):
-        result = []
-        while not session['queue'].empty():
-            result.append(session['queue'].get())
+        result = self.take_session_output(session)
         if len(result) == 0:
             return
         return_string = self.escape_ansi("".join(result))
         if not return_string.strip():
             return
-        while len(return_string) > 1700:
-            await session['channel'].send("```\n" + return_string[0:1700] + "```")
-            return_string = return_string[1700:]
-        await session['channel'].send("```\n" + return_string + "```")
+        rm = session['channel']
+        self.publish_output(session, self.render_output(rm.id, return_string))
+
+    def render_output(self, channel_id, text):
+        # Returns a list of (content, attachment, mention) messages, where
+        # mention is the only user id the message may ping. Output past
+        # the channel's limits becomes a preview plus one attached file
+        # instead of a long run of code blocks.
+        limits = self.get_attach_limits(channel_id)
+        chunks = [text[i:i + 1700] for i in range(0, len(text), 1700)]
+        data = text.encode("utf-8")
+        if len(chunks) <= limits['chunks'] and len(data) <= limits['kb'] * 1024:
+            return [("```\n" + chunk + "```", None, None) for chunk in chunks]
+        preview = text[:output_preview_size]
+        if preview.rfind("\n") > 0:
+            preview = preview[:preview.rfind("\n") + 1]
+        filename = "output.txt"
+        if limits['gzip']:
+            data = gzip.compress(data)
+            filename += ".gz"
+        note = "Full output attached ({} lines, {:.1f} KB).".format(
+            len(text.splitlines()), len(data) / 1024)
+        return [("```\n" + preview + "```" + note, (filename, data), None)]
+
+    async def deliver_output(self, rm, messages):
+        for content, attachment, mention in messages:
+            # Session output comes from the game, never let it ping anyone.
+            allowed = discord.AllowedMentions.none()
+            if mention:
+                allowed = discord.AllowedMentions(everyone=False, roles=False,
+                                                  users=[discord.Object(mention)])
+            if attachment:
+                filename, data = attachment
+                await rm.send(content, file=discord.File(io.BytesIO(data), filename=filename),
+                              allowed_mentions=allowed)
+            else:
+                await rm.send(content, allowed_mentions=allowed)
 
+    async def set_mud_prompt(self, message_data):
+        rm = message_data.channel
+        prompts = self.bot_settings['mud_prompts']
+        termslist = message_data.content.split(" ", 1)
+        if len(termslist) < 2 or not termslist[1].strip():
+            pattern = prompts.get(str(rm.id))
+            if pattern:
+                await rm.send("Prompt pattern for this channel: `" + pattern + "`")
+            else:
+                await rm.send("No prompt pattern set for this channel.")
+            return
+        pattern = termslist[1].strip()
+        session = self.game_sessions.get(rm.id)
+        if pattern.lower() == "none":
+            prompts.pop(str(rm.id), None)
+            self.save_settings()
+            if session:
+                session['prompt_re'] = None
+            await rm.send("Prompt pattern for this channel cleared.")
+            return
+        try:
+            compiled = re.compile(pattern)
+        except re.error as e:
+            await rm.send("Invalid prompt pattern: " + str(e))
+            return
+        prompts[str(rm.id)] = pattern
+        self.save_settings()
+        if session:
+            session['prompt_re'] = compiled
+        await rm.send("Prompt pattern for this channel set to `" + pattern + "`")
+
+    def get_mud_prompt(self, channel_id):
+        pattern = self.bot_settings['mud_prompts'].get(str(channel_id))
+        if pattern:
+            return re.compile(pattern)
+
+    def send_trigger_hits(self, session):
+        hits = session['trigger_hits']
+        session['trigger_hits'] = []
+        by_user = {}
+        for triggers, line in hits:
+            for trigger in triggers:
+                key = (trigger['user'], trigger['dm'])
+                lines = by_user.setdefault(key, [])
+                if line not in lines and len(lines) < trigger_hit_limit:
+                    lines.append(line)
+        rm = session['channel']
+        for (user_id, dm), lines in by_user.items():
+            if not dm:
+                text = self.quote_trigger_lines("<@{}>".format(user_id), lines)
+                self.publish_output(session, [(text, None, user_id)], rm.id)
+                continue
+            if session['trigger_dms'].full():
+                print("Trigger DM for " + str(user_id) + " dropped, too many waiting.")
+                continue
+            session['trigger_dms'].put_nowait((user_id, self.quote_trigger_lines("Trigger in #" + rm.name + ":", lines)))
+
+    def quote_trigger_lines(self, header, lines):
+        # Long MUD lines are cut short, and lines stop being added before
+        # the message would go over discord's 2000 character limit.
+        text = header
+        for line in lines:
+            if len(line) > trigger_line_limit:
+                line = line[:trigger_line_limit] + "..."
+            quoted = "\n> " + discord.utils.escape_markdown(discord.utils.escape_mentions(line))
+            if len(text) + len(quoted) > 2000:
+                break
+            text += quoted
+        return text
 
-    async def check_muds(self):
-        await self.wait_until_ready()
-        while not self.is_closed():
+    async def deliver_trigger_dms(self, session):
+        # DMs go out from their own task, a slow or rate limited DM must
+        # not hold up the session's output.
+        while True:
+            user_id, text = await session['trigger_dms'].get()
             try:
-                for k, session in self.game_sessions.items():
-                    try:
-                        await self.send_mud_output(session)
-                    except Exception as e:
-                        pass
-            except:
-                pass
-            await asyncio.sleep(2)
+                user = self.get_user(user_id) or await self.fetch_user(user_id)
+                await user.send(text, allowed_mentions=discord.AllowedMentions.none())
+            except discord.HTTPException as e:
+                print(e)
+
+    async def add_mirror(self, message_data):
+        rm = message_data.channel
+        session = self.get_session(rm.id)
+        if not session:
+            await rm.send("No session found for this channel.")
+            return
+        mirrors = [sub['channel'] for sub in session['subscribers'].values() if sub['channel'] != rm]
+        termslist = message_data.content.strip().split(" ")
+        if len(termslist) == 1:
+            if not mirrors:
+                await rm.send("This session is not mirrored.")
+            else:
+                await rm.send("Mirrored to: " + ", ".join(self.describe_channel(x) for x in mirrors))
+            return
+        target = self.find_channel(termslist[1])
+        if target is None or getattr(target, 'guild', None) is None:
+            await rm.send("Channel not found.")
+            return
+        if not isinstance(target, discord.abc.Messageable):
+            await rm.send("Sessions can't be shown in that kind of channel.")
+            return
+        if target.id in session['subscribers']:
+            await rm.send("Session already shown in that channel.")
+            return
+        if self.get_session(target.id) or self.get_mirror_source(target.id):
+            await rm.send("That channel already shows a session.")
+            return
+        member = target.guild.get_member(message_data.author.id)
+        if member is None or not target.permissions_for(member).send_messages:
+            await rm.send("You need to be able to send messages in that channel.")
+            return
+        if not target.permissions_for(target.guild.me).send_messages:
+            await rm.send("I can't send messages in that channel.")
+            return
+        try:
+            await target.send("Now mirroring the session from " + self.describe_channel(rm) + ".")
+        except discord.HTTPException as e:
+            print(e)
+            await rm.send("Unable to send messages in that channel.")
+            return
+        if self.get_session(rm.id) is not session or target.id in session['subscribers']:
+            return # Session stopped or mirror added meanwhile.
+        self.add_subscriber(session, target)
+        await rm.send("Session mirrored to " + self.describe_channel(target) + ".")
+
+    async def rem_mirror(self, message_data):
+        rm = message_data.channel
+        session = self.get_session(rm.id)
+        termslist = message_data.content.strip().split(" ")
+        if len(termslist) < 2:
+            await rm.send("Usage: %unmirror (channel)")
+            return
+        # Looked up among the subscribers, not through get_channel, so a
+        # mirror whose channel was deleted or hidden can still be removed.
+        target_id = self.parse_channel_id(termslist[1])
+        if not session or target_id is None or target_id == rm.id or target_id not in session['subscribers']:
+            await rm.send("Mirror not found.")
+            return
+        target = session['subscribers'][target_id]['channel']
+        self.remove_subscriber(session, target_id)
+        await rm.send("Stopped mirroring to " + self.describe_channel(target) + ".")
+
+    def get_session(self, channel_id):
+        return self.game_sessions.get(channel_id) or self.if_sessions.get(channel_id)
+
+    def get_mirror_source(self, channel_id):
+        # The session a channel is mirroring, if any.
+        for session in list(self.game_sessions.values()) + list(self.if_sessions.values()):
+            if channel_id in session['subscribers'] and session['channel'].id != channel_id:
+                return session
+        return None
+
+    async def refuse_if_mirror(self, rm):
+        source = self.get_mirror_source(rm.id)
+        if source:
+            await rm.send("This channel mirrors the session in {}. Use unmirror there first.".format(
+                self.describe_channel(source['channel'])))
+        return source is not None
+
+    def parse_channel_id(self, text):
+        # Accepts a channel mention or a plain channel id.
+        match = re.fullmatch(r"<#(\d+)>|(\d+)", text)
+        if not match:
+            return None
+        return int(match.group(1) or match.group(2))
+
+    def find_channel(self, text):
+        channel_id = self.parse_channel_id(text)
+        return None if channel_id is None else self.get_channel(channel_id)
+
+    def describe_channel(self, rm):
+        return "#{} ({})".format(rm.name, rm.guild.name)
+
+    async def add_trigger(self, message_data):
+        rm = message_data.channel
+        user_id = message_data.author.id
+        triggers = self.bot_settings['triggers'].setdefault(str(rm.id), [])
+        mine = [t for t in triggers if t['user'] == user_id]
+        termslist = message_data.content.strip().split(" ")
+        if len(termslist) == 1:
+            if not mine:
+                await rm.send("You have no triggers in this channel.")
+            else:
+                listing = [("dm " if t['dm'] else "")
+                    + ("/" + t['pattern'] + "/" if t['regex'] else t['pattern']) for t in mine]
+                await rm.send("Your triggers:\n```\n" + "\n".join(listing) + "```")
+            return
+        dm = termslist[1].lower() == "dm"
+        pattern = " ".join(termslist[2:] if dm else termslist[1:]).strip()
+        regex = len(pattern) > 2 and pattern.startswith("/") and pattern.endswith("/")
+        if regex:
+            pattern = pattern[1:-1]
+            # A pattern runs on every line of output, one with catastrophic
+            # backtracking would stall the bot, so only permitted roles get
+            # to add them.
+            if not self.has_permission(message_data):
+                await rm.send("Only permitted roles can add /pattern/ triggers.")
+                return
+            error = TriggerMatcher.check_pattern(pattern)
+            if error:
+                await rm.send(error)
+                return
+        if not pattern:
+            await rm.send("Usage: %trigger [dm] (text or /pattern/)")
+            return
+        if [t for t in mine if t['pattern'] == pattern and t['regex'] == regex]:
+            await rm.send("Trigger already added.")
+            return
+        if len(mine) >= trigger_user_limit:
+            await rm.send("You can have at most {} triggers per channel.".format(trigger_user_limit))
+            return
+        trigger = {'user': user_id, 'pattern': pattern, 'regex': regex, 'dm': dm}
+        if regex:
+            try:
+                TriggerMatcher(triggers + [trigger])
+            except re.error as e:
+                await rm.send("That pattern doesn't work with this channel's other triggers: " + str(e))
+                return
+        triggers.append(trigger)
+        self.trigger_matchers.pop(rm.id, None)
+        self.save_settings()
+        await rm.send("Trigger added.")
+
+    async def rem_trigger(self, message_data):
+        rm = message_data.channel
+        user_id = message_data.author.id
+        triggers = self.bot_settings['triggers'].get(str(rm.id), [])
+        termslist = message_data.content.strip().split(" ")
+        if len(termslist) < 2:
+            await rm.send("Usage: %untrigger (text or /pattern/)")
+            return
+        pattern = " ".join(termslist[1:])
+        regex = len(pattern) > 2 and pattern.startswith("/") and pattern.endswith("/")
+        if regex:
+            pattern = pattern[1:-1]
+        remaining = [t for t in triggers
+                     if not (t['user'] == user_id and t['pattern'] == pattern and t['regex'] == regex)]
+        if len(remaining) == len(triggers):
+            await rm.send("Trigger not found.")
+            return
+        if remaining:
+            self.bot_settings['triggers'][str(rm.id)] = remaining
+        else:
+            self.bot_settings['triggers'].pop(str(rm.id))
+        self.trigger_matchers.pop(rm.id, None)
+        self.save_settings()
+        await rm.send("Trigger removed.")
+
+    def get_trigger_matcher(self, channel_id):
+        triggers = self.bot_settings['triggers'].get(str(channel_id))
+        if not triggers:
+            return None
+        matcher = self.trigger_matchers.get(channel_id)
+        if matcher is None:
+            try:
+                matcher = TriggerMatcher(triggers)
+            except re.error as e:
+                # Runs inside the session reader, a stored pattern that no
+                # longer combines must not end the session.
+                print(e)
+                matcher = TriggerMatcher([t for t in triggers if not t['regex']])
+            self.trigger_matchers[channel_id] = matcher
+        return matcher
+
+    async def set_attach_limits(self, message_data):
+        rm = message_data.channel
+        termslist = message_data.content.strip().split(" ")
+        usage = "Usage: %attachlimit [kb] [messages] [gzip], or %attachlimit default"
+        if len(termslist) == 1:
+            limits = self.get_attach_limits(rm.id)
+            await rm.send("Output over {} KB or {} messages is sent as {} file.".format(
+                limits['kb'], limits['chunks'], "a gzip" if limits['gzip'] else "a text"))
+            return
+        if termslist[1].lower() == "default":
+            self.bot_settings['attach_limits'].pop(str(rm.id), None)
+            self.save_settings()
+            await rm.send("Attachment limits for this channel reset.")
+            return
+        if len(termslist) not in (3, 4) or (len(termslist) == 4 and termslist[3].lower() != "gzip"):
+            await rm.send(usage)
+            return
+        try:
+            kb = int(termslist[1])
+            chunks = int(termslist[2])
+        except ValueError:
+            await rm.send(usage)
+            return
+        if kb < 1 or chunks < 1:
+            await rm.send(usage)
+            return
+        self.bot_settings['attach_limits'][str(rm.id)] = {
+                'kb': kb,
+                'chunks': chunks,
+                'gzip': len(termslist) == 4,
+                }
+        self.save_settings()
+        await rm.send("Attachment limits for this channel set.")
+
+    def get_attach_limits(self, channel_id):
+        limits = self.bot_settings['attach_limits'].get(str(channel_id))
+        if limits:
+            return limits
+        return {'kb': attach_size_kb, 'chunks': attach_chunk_limit, 'gzip': False}
 
     async def add_perm(self, message_data):
         server = message_data.guild.id
@@ -706,16 +1729,8 @@ class BotApp(discord.Client):
                 cmd = message[len(prefix):].lower()
             else:
                 cmd = message[len(prefix):message.find(' ')].lower()
-            if cmd in self.restricted:
-                if message_data.author.guild_permissions.administrator:
-                    pass
-                else:
-                    permits = self.bot_settings['permissions'].get(str(message_data.guild.id))
-                    if not permits or not permits.get('perms'):
-                        return
-                    user_roles = [str(x) for x in message_data.author.roles]
-                    if not [x for x in permits['perms'] if x in user_roles]:
-                            return
+            if cmd in self.restricted and not self.has_permission(message_data):
+                return
             if cmd in self.mycmds:
                 await self.mycmds[cmd](message_data)
             return
@@ -728,6 +1743,15 @@ class BotApp(discord.Client):
                     await message_data.channel.send(custom_cmds[cmd])
 
 
+    def has_permission(self, message_data):
+        if message_data.author.guild_permissions.administrator:
+            return True
+        permits = self.bot_settings['permissions'].get(str(message_data.guild.id))
+        if not permits or not permits.get('perms'):
+            return False
+        user_roles = [str(x) for x in message_data.author.roles]
+        return bool([x for x in permits['perms'] if x in user_roles])
+
     def get_prefix(self, guild_id, custom=False):
         prefix_key = 'prefixes'
         default_key = 'default_prefix'
@@ -749,6 +1773,10 @@ class BotApp(discord.Client):
             'custom_commands': {},
             'random_emote_servers': [],
             'permissions': {},
+            'mud_prompts': {},
+            'if_saves': {},
+            'attach_limits': {},
+            'triggers': {},
         }
 
     def save_settings(self):
@@ -764,6 +1792,14 @@ class BotApp(discord.Client):
                 settings = json.loads(f.read())
                 if not 'permissions' in settings:
                     settings['permissions'] = {}
+                if not 'mud_prompts' in settings:
+                    settings['mud_prompts'] = {}
+                if not 'if_saves' in settings:
+                    settings['if_saves'] = {}
+                if not 'attach_limits' in settings:
+                    settings['attach_limits'] = {}
+                if not 'triggers' in settings:
+                    settings['triggers'] = {}
                 return settings
         except Exception as e:
             print(e)
@@ -788,6 +1824,12 @@ class BotApp(discord.Client):
             "md": self.send_mud_command,
             "mudstart": self.start_mud,
             "mudstop": self.kill_mud,
+            "mudprompt": self.set_mud_prompt,
+            "attachlimit": self.set_attach_limits,
+            "trigger": self.add_trigger,
+            "untrigger": self.rem_trigger,
+            "mirror": self.add_mirror,
+            "unmirror": self.rem_mirror,
             "perm": self.add_perm,
             "unperm": self.rem_perm,
             "blacklist": self.blacklist,
@@ -800,13 +1842,17 @@ class BotApp(discord.Client):
         "prefix", "customprefix", "add", "remove",
         "addrandemotes", "remrandemotes",
         "perm", "unperm", "blacklist", "unblacklist",
+        "mudprompt", "attachlimit",
         ]
 
 
 if __name__ == "__main__":
+    with open(os.path.join(script_path, "bot_key")) as f:
+        my_key = f.readline().replace("\n", "")
+        ai_access_id = f.readline().replace("\n", "")
+        ai_access_key = f.readline().replace("\n", "")
     intents = discord.Intents(members=True, messages=True, message_content=True, emojis=True, guilds=True)
     bot_app = BotApp(intents)
-    # bot_app.loop.create_task(bot_app.check_muds()) ### Need to update this for discordpy 2
     bot_app.run(my_key)
     print("Finished processes, exiting.")
 
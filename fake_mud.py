@@ -0,0 +1,193 @@
+"""Fake MUD server for trying out and benchmarking the bot's MUD sessions.
+
+Runs a tiny telnet MUD that speaks just enough of the protocol to
+exercise the bot: it offers EOR and MCCP2 (compression), marks every
+prompt with IAC EOR, or IAC GA if the client refuses EOR, and answers a
+handful of commands.
+
+Usage:
+    python fake_mud.py serve [port]
+        Run the server, default port 4000. Add "localhost" to
+        telnet_allowed_hosts in discordbot.py, then use '%mudstart telnet
+        localhost 4000' in discord, or '%mudstart' and '%md /connect
+        localhost 4000' to go through TinyFugue.
+
+    python fake_mud.py bench [sessions] [commands]
+        Start the server and compare the telnet backend against
+        TinyFugue: memory per session and round trip time per command.
+        Defaults: 20 sessions, 50 commands each. Linux only, memory is
+        read from /proc.
+
+Commands:
+    look: A room description.
+    ping (n): Answers 'pong (n)', used by the benchmark.
+    spam (lines): Sends that many lines at once.
+    quit: Disconnects.
+    Anything else is echoed back.
+"""
+
+import asyncio
+import os
+import statistics
+import sys
+import time
+import zlib
+
+from discordbot import TelnetClient, tiny_fugue_path
+
+IAC, DONT, DO, WONT, WILL, SB, GA, SE, EOR = 255, 254, 253, 252, 251, 250, 249, 240, 239
+OPT_EOR, OPT_MCCP2 = 25, 86
+
+room = """The Fake Tavern
+A small, smoky room. A bored barkeep polishes the same glass over and
+over. A sign on the wall reads 'No dragons'.
+Exits: north, south."""
+
+
+async def handle_client(reader, writer):
+    client = {'eor': False, 'compress': None}
+
+    def send(text, prompt=True):
+        data = (text + "\n").replace("\n", "\r\n").encode("utf-8")
+        if prompt:
+            data += b"> " + bytes((IAC, EOR if client['eor'] else GA))
+        if client['compress']:
+            data = client['compress'].compress(data) + client['compress'].flush(zlib.Z_SYNC_FLUSH)
+        writer.write(data)
+
+    writer.write(bytes((IAC, WILL, OPT_EOR, IAC, WILL, OPT_MCCP2)))
+    send("Welcome to the fake MUD.")
+    buf = b""
+    while True:
+        data = await reader.read(4096)
+        if not data:
+            break
+        buf += data
+        while IAC in buf:
+            i = buf.index(IAC)
+            if len(buf) < i + 3:
+                break
+            cmd, option = buf[i + 1], buf[i + 2]
+            buf = buf[:i] + buf[i + 3:]
+            if cmd == DO and option == OPT_EOR:
+                client['eor'] = True
+            elif cmd == DO and option == OPT_MCCP2 and not client['compress']:
+                writer.write(bytes((IAC, SB, OPT_MCCP2, IAC, SE)))
+                client['compress'] = zlib.compressobj()
+        *lines, buf = buf.split(b"\n")
+        for line in lines:
+            command = line.decode("utf-8", "replace").strip()
+            words = command.split(" ")
+            if command == "look":
+                send(room)
+            elif words[0] == "ping":
+                send("pong " + " ".join(words[1:]))
+            elif words[0] == "spam" and len(words) == 2 and words[1].isdigit():
+                send("\n".join("Line {} of {}: the barkeep sighs.".format(x + 1, words[1])
+                               for x in range(int(words[1]))))
+            elif command == "quit":
+                send("Bye.", prompt=False)
+                await writer.drain()
+                writer.close()
+                return
+            else:
+                send("You " + command + ".")
+        await writer.drain()
+    writer.close()
+
+
+async def serve(port):
+    server = await asyncio.start_server(handle_client, "localhost", port)
+    print("Fake MUD listening on localhost " + str(port))
+    async with server:
+        await server.serve_forever()
+
+
+def read_rss(pid):
+    with open("/proc/{}/status".format(pid)) as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+async def read_until(stream, token):
+    buf = b""
+    while token not in buf:
+        data = await stream.read(4096)
+        if not data:
+            raise ConnectionError("Connection closed")
+        buf = buf[-len(token):] + data
+
+
+async def time_commands(stdin, stdout, commands):
+    times = []
+    for x in range(commands):
+        start = time.perf_counter()
+        stdin.write("ping {}\n".format(x).encode("utf-8"))
+        await stdin.drain()
+        await read_until(stdout, "pong {}".format(x).encode("utf-8"))
+        times.append(time.perf_counter() - start)
+    return times
+
+
+async def bench_telnet(port, sessions, commands):
+    rss_before = read_rss(os.getpid())
+    clients = [await TelnetClient.connect("localhost", port) for x in range(sessions)]
+    for client in clients:
+        await read_until(client, b"Welcome")
+    rss = (read_rss(os.getpid()) - rss_before) / sessions
+    results = await asyncio.gather(*[time_commands(c, c, commands) for c in clients])
+    for client in clients:
+        client.terminate()
+    return rss, [t for times in results for t in times]
+
+
+async def bench_tf(port, sessions, commands):
+    procs = []
+    for x in range(sessions):
+        procs.append(await asyncio.create_subprocess_exec(
+            tiny_fugue_path, "-v", "localhost", str(port),
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE))
+    for proc in procs:
+        await read_until(proc.stdout, b"Welcome")
+    rss = sum(read_rss(proc.pid) for proc in procs) / sessions
+    results = await asyncio.gather(*[time_commands(p.stdin, p.stdout, commands) for p in procs])
+    for proc in procs:
+        proc.terminate()
+        await proc.wait()
+    return rss, [t for times in results for t in times]
+
+
+def report(name, rss, times):
+    times = sorted(times)
+    print("{:8} {:>10.0f} KB {:>10.2f} ms {:>10.2f} ms".format(
+        name, rss, statistics.median(times) * 1000, times[int(len(times) * 0.95)] * 1000))
+
+
+async def bench(sessions, commands):
+    port = 4099
+    server = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), "serve", str(port),
+                                                  stdout=asyncio.subprocess.DEVNULL)
+    await asyncio.sleep(1)
+    print("{} sessions, {} commands each".format(sessions, commands))
+    print("{:8} {:>13} {:>13} {:>13}".format("backend", "rss/session", "median", "p95"))
+    try:
+        report("telnet", *await bench_telnet(port, sessions, commands))
+        try:
+            report("tf", *await bench_tf(port, sessions, commands))
+        except FileNotFoundError:
+            print("TinyFugue not found, skipping the tf backend.")
+    finally:
+        server.terminate()
+        await server.wait()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args[:1] == ["serve"]:
+        asyncio.run(serve(int(args[1]) if len(args) > 1 else 4000))
+    elif args[:1] == ["bench"]:
+        asyncio.run(bench(int(args[1]) if len(args) > 1 else 20, int(args[2]) if len(args) > 2 else 50))
+    else:
+        print(__doc__)
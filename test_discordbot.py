@@ -0,0 +1,410 @@
+import asyncio
+import collections
+import gzip
+import re
+import types
+import zlib
+
+import discord
+
+import discordbot
+import fake_mud
+
+
+def make_trigger(pattern, regex=False, user=1):
+    return {'user': user, 'pattern': pattern, 'regex': regex, 'dm': False}
+
+
+def matched(matcher, line):
+    return [t['pattern'] for t in matcher.match(line)]
+
+
+def test_trigger_literals_overlap_and_ignore_case():
+    matcher = discordbot.TriggerMatcher([make_trigger(x) for x in ("he", "she", "hers", "Bob")])
+    assert sorted(matched(matcher, "Ushers see BOB")) == ["Bob", "he", "hers", "she"]
+    assert matched(matcher, "nothing here") == ["he"]
+    assert matched(matcher, "quiet") == []
+
+
+def test_trigger_patterns_all_reported_from_one_scan():
+    matcher = discordbot.TriggerMatcher([
+        make_trigger(r"bob", True),
+        make_trigger(r"bo+", True),
+        make_trigger(r"boss \w+ spawned", True),
+        make_trigger(r"(?:z)z", True),
+        ])
+    assert matched(matcher, "bobby") == ["bob", "bo+"]
+    assert matched(matcher, "The boss dragon spawned, zz") == ["bo+", "boss \\w+ spawned", "(?:z)z"]
+    assert matched(matcher, "nothing") == []
+
+
+def test_trigger_pattern_checks():
+    check = discordbot.TriggerMatcher.check_pattern
+    assert check(r"\w+ tells you") is None
+    assert check(r"(a)\1") is not None
+    assert check(r"(?(1)a|b)") is not None
+    assert check(r"(?i)a") is not None
+    assert check(r"(?P<w>\w+) tells") is not None
+    assert check(r"(?P=w)") is not None
+    assert check("a" * (discordbot.trigger_pattern_limit + 1)) is not None
+    # Stored patterns that fail the checks are skipped, not combined.
+    matcher = discordbot.TriggerMatcher([make_trigger(r"(a)\1", True), make_trigger(r"(b)\1", True)])
+    assert matched(matcher, "xx bb yy") == []
+    # Two stored patterns naming a group the same used to break the
+    # combined regex, and with it the session reader.
+    matcher = discordbot.TriggerMatcher([make_trigger(r"(?P<w>\w+) tells", True),
+                                         make_trigger(r"(?P<w>\w+) says", True), make_trigger("tells")])
+    assert matched(matcher, "Bob tells you hi") == ["tells"]
+
+
+class FakeWriter:
+    def __init__(self):
+        self.data = b""
+
+    def write(self, data):
+        self.data += data
+
+
+def make_client():
+    writer = FakeWriter()
+    return discordbot.TelnetClient(None, writer), writer
+
+
+def feed_bytewise(client, data):
+    return b"".join(client.feed(data[i:i + 1]) for i in range(len(data)))
+
+
+def test_telnet_negotiation_replies():
+    client, writer = make_client()
+    IAC, DO, DONT, WONT, WILL = 255, 253, 254, 252, 251
+    out = client.feed(bytes((IAC, WILL, 1, IAC, WILL, 99, IAC, DO, 24, IAC, WILL, 1)) + b"hi\r\n")
+    assert out == b"hi\n"
+    # Each reply is only sent once, repeats don't start a negotiation loop.
+    assert writer.data == bytes((IAC, DO, 1, IAC, DONT, 99, IAC, WONT, 24))
+
+
+def test_telnet_iac_split_across_reads():
+    client, writer = make_client()
+    assert client.feed(b"> \xff") == b"> "
+    assert client.feed(b"\xefnext\r\n") == b"\xff\xf9next\n"
+    assert client.feed(b"\xff\xfb") == b""
+    assert client.feed(b"\x19\xff\xff") == b""
+    assert writer.data == b"\xff\xfd\x19"
+    assert feed_bytewise(make_client()[0], b"a\xff\xfa\x18\x00xterm\xff\xf0b\xff\xf9") == b"ab\xff\xf9"
+
+
+def test_telnet_mccp_starts_mid_buffer():
+    compress = zlib.compressobj()
+    packed = compress.compress(b"Squeezed.\r\n> \xff\xef") + compress.flush(zlib.Z_SYNC_FLUSH)
+    data = b"Plain.\r\n\xff\xfa\x56\xff\xf0" + packed
+    expected = b"Plain.\nSqueezed.\n> \xff\xf9"
+    assert make_client()[0].feed(data) == expected
+    assert feed_bytewise(make_client()[0], data) == expected
+    # The stream ending hands what follows back to the plain parser.
+    client = make_client()[0]
+    assert client.feed(data + compress.flush() + b"After.\r\n") == expected + b"After.\n"
+    assert client.inflate is None
+
+
+async def read_until(client, token):
+    buf = b""
+    while token not in buf:
+        data = await asyncio.wait_for(client.read(), 5)
+        if not data:
+            break
+        buf += data
+    return buf
+
+
+def test_telnet_client_against_fake_mud():
+    async def run():
+        server = await asyncio.start_server(fake_mud.handle_client, "localhost", 0)
+        port = server.sockets[0].getsockname()[1]
+        client = await discordbot.TelnetClient.connect("localhost", port)
+        try:
+            assert b"Welcome to the fake MUD." in await read_until(client, b"\xff\xf9")
+            client.write(b"ping 7\n")
+            await client.drain()
+            assert await read_until(client, b"\xff\xf9") == b"pong 7\n> \xff\xf9"
+            assert client.inflate is not None
+            client.write(b"spam 300\n")
+            await client.drain()
+            assert (await read_until(client, b"\xff\xf9")).count(b"the barkeep sighs") == 300
+            client.write(b"quit\n")
+            await client.drain()
+            assert await read_until(client, b"never") == b"Bye.\n"
+        finally:
+            client.terminate()
+            server.close()
+            await server.wait_closed()
+    asyncio.run(run())
+
+
+def make_app():
+    app = discordbot.BotApp.__new__(discordbot.BotApp)
+    app.bot_settings = app.create_default_settings()
+    return app
+
+
+def make_input_session():
+    return {'input': {}, 'input_order': collections.deque(), 'input_count': 0,
+            'input_ready': asyncio.Event(), 'rates': {}}
+
+
+def test_session_input_round_robin_and_limit():
+    app = make_app()
+    session = make_input_session()
+    assert app.queue_session_input(session, 1, [b"a1\n", b"a2\n", b"a3\n"])
+    assert app.queue_session_input(session, 2, [b"b1\n"])
+    assert app.take_session_input(session, 0) == ([b"a1\n", b"b1\n", b"a2\n", b"a3\n"], None)
+    assert session['input_count'] == 0 and not session['input']
+    assert not app.queue_session_input(session, 3, [b"x\n"] * (discordbot.input_queue_limit + 1))
+
+
+def test_session_input_rate_limit():
+    app = make_app()
+    session = make_input_session()
+    burst, rate = discordbot.user_line_burst, discordbot.user_line_rate
+    app.queue_session_input(session, 1, [b"a\n"] * (burst + 3))
+    app.queue_session_input(session, 2, [b"b\n"])
+    batch, wait = app.take_session_input(session, 0)
+    assert len(batch) == burst + 1 and batch.count(b"b\n") == 1
+    assert wait == 1 / rate
+    assert app.take_session_input(session, 0.5 * wait) == ([], 0.5 * wait)
+    assert app.take_session_input(session, 2 / rate) == ([b"a\n"] * 2, 1 / rate)
+
+
+def test_render_output_chunks_then_attaches():
+    app = make_app()
+    text = "x" * 3000
+    assert app.render_output(1, text) == [("```\n" + "x" * 1700 + "```", None, None),
+                                          ("```\n" + "x" * 1300 + "```", None, None)]
+    text = "".join("Line {}\n".format(x) for x in range(2000))
+    [(content, (filename, data), mention)] = app.render_output(1, text)
+    assert filename == "output.txt" and data == text.encode("utf-8") and mention is None
+    assert content.startswith("```\nLine 0\n") and "(2000 lines" in content
+    assert len(content) < discordbot.output_preview_size + 100
+    app.bot_settings['attach_limits']["1"] = {'kb': 1, 'chunks': 1, 'gzip': True}
+    [(content, (filename, data), mention)] = app.render_output(1, "y" * 2000)
+    assert filename == "output.txt.gz" and gzip.decompress(data) == b"y" * 2000
+
+
+def test_trigger_matcher_that_fails_to_build_keeps_literals(monkeypatch):
+    # Patterns stored before the checks got stricter may no longer
+    # combine, the channel then loses its pattern triggers, not its reader.
+    monkeypatch.setattr(discordbot.TriggerMatcher, "check_pattern", staticmethod(lambda pattern: None))
+    app = make_app()
+    app.trigger_matchers = {}
+    app.bot_settings['triggers']["1"] = [make_trigger(r"(?P<w>\w+) tells", True),
+                                         make_trigger(r"(?P<w>\w+) says", True), make_trigger("tells")]
+    assert matched(app.get_trigger_matcher(1), "Bob tells you hi") == ["tells"]
+
+
+def test_trigger_hits_fit_one_message():
+    app = make_app()
+    text = app.quote_trigger_lines("<@1>", ["*" * 5000] * discordbot.trigger_hit_limit)
+    assert len(text) <= 2000
+    assert text.startswith("<@1>\n> " + "\\*" * discordbot.trigger_line_limit + "...")
+    assert app.quote_trigger_lines("<@1>", ["@everyone hi"]) == "<@1>\n> @​everyone hi"
+
+
+class FakeChannel:
+    def __init__(self, channel_id, gate=None, error=None):
+        self.id = channel_id
+        self.name = "channel" + str(channel_id)
+        self.guild = types.SimpleNamespace(name="guild")
+        self.gate = gate
+        self.error = error
+        self.sent = []
+
+    async def send(self, content, **kwargs):
+        if self.error:
+            raise self.error
+        if self.gate:
+            await self.gate.wait()
+        self.sent.append(content)
+
+
+def make_fanout_session(app, *mirrors):
+    session = {'channel': FakeChannel(1), 'subscribers': {}}
+    for rm in (session['channel'],) + mirrors:
+        app.add_subscriber(session, rm)
+    return session
+
+
+def test_slow_mirror_skips_output_primary_keeps_all():
+    async def run():
+        app = make_app()
+        gate = asyncio.Event()
+        mirror = FakeChannel(2, gate=gate)
+        session = make_fanout_session(app, mirror)
+        updates = discordbot.subscriber_queue_limit + 10
+        for x in range(updates):
+            app.publish_output(session, [(str(x), None, None)])
+            await asyncio.sleep(0)
+        await asyncio.sleep(0.01)
+        assert session['channel'].sent == [str(x) for x in range(updates)]
+        gate.set()
+        await asyncio.sleep(0.01)
+        assert mirror.sent[:2] == ["0", "(9 updates skipped, this channel fell behind.)"]
+        assert mirror.sent[2:] == [str(x) for x in range(10, updates)]
+        for sub in session['subscribers'].values():
+            sub['task'].cancel()
+    asyncio.run(run())
+
+
+def test_mirror_dropped_when_its_channel_is_gone():
+    async def run():
+        app = make_app()
+        gone = discord.NotFound(types.SimpleNamespace(status=404, reason="Not Found"), "Unknown Channel")
+        session = make_fanout_session(app, FakeChannel(2, error=gone), FakeChannel(3))
+        app.publish_output(session, [("hi", None, None)])
+        await asyncio.sleep(0.01)
+        assert list(session['subscribers']) == [1, 3]
+        # unmirror works from the stored subscriber, the channel need not resolve.
+        app.game_sessions = {1: session}
+        app.if_sessions = {}
+        app.get_channel = lambda channel_id: None
+        message = types.SimpleNamespace(channel=session['channel'], content="%unmirror <#3>")
+        await app.rem_mirror(message)
+        assert list(session['subscribers']) == [1]
+        assert session['channel'].sent[-1] == "Stopped mirroring to #channel3 (guild)."
+        session['subscribers'][1]['task'].cancel()
+    asyncio.run(run())
+
+
+class FakeProcess:
+    # Stands in for tf or TelnetClient: output is fed in by the test,
+    # input is recorded.
+    def __init__(self, chunks=()):
+        self.stdin = self.stdout = self
+        self.output = asyncio.Queue()
+        for chunk in chunks:
+            self.output.put_nowait(chunk)
+        self.written = b""
+
+    async def read(self, n=4096):
+        return await self.output.get()
+
+    def write(self, data):
+        self.written += data
+
+    async def drain(self):
+        pass
+
+    def terminate(self):
+        self.output.put_nowait(b"")
+
+
+def read_prompts(chunks, prompt=None, awaiting=5):
+    # Runs the reader over the chunks to EOF, returns how many prompts
+    # it counted and what it buffered.
+    async def run():
+        app = make_app()
+        app.trigger_matchers = {}
+        session = {'channel': FakeChannel(1), 'prompt_re': re.compile(prompt) if prompt else None,
+                   'sp': FakeProcess(list(chunks) + [b""])}
+        app.open_session(session, session['sp'])
+        session['pump'].cancel()
+        session['awaiting_prompts'] = awaiting
+        await session['reader']
+        app.stop_session_process(session)
+        return awaiting - session['awaiting_prompts'], app.take_session_output(session)
+    return asyncio.run(run())
+
+
+def test_reader_counts_telnet_and_pattern_prompts_once():
+    assert read_prompts([b"pong\n> \xff\xf9"], r"^> ") == (1, ["pong\n", "> "])
+    assert read_prompts([b"pong\n>", b" ", b"\xff\xf9", b"You wait.\n"], r"^> $") == (1, ["pong\n", "> You wait.\n"])
+    assert read_prompts([b"> \xff\xf9> \xff\xf9"], r"^> ") == (2, ["> > "])
+    assert read_prompts([b"a\n> \xff\xf9b\n> \xff\xf9"]) == (2, ["a\n", "> b\n", "> "])
+
+
+def test_reader_counts_split_pattern_prompts():
+    assert read_prompts([b"a\n> ", b"b\n> "], r"^> ") == (2, ["a\n", "> b\n", "> "])
+    assert read_prompts([b"HP:10", b"0> ", b"north\n"], r"> $") == (1, ["HP:100> north\n"])
+    assert read_prompts([b"x\n\xff\xf9"], r"^> ", awaiting=0) == (0, ["x\n"])
+
+
+def test_pump_flushes_once_per_batch(monkeypatch):
+    monkeypatch.setattr(discordbot, "mud_quiet_period", 2)
+    async def run():
+        app = make_app()
+        app.trigger_matchers = {}
+        sent = []
+        async def send_output(session):
+            sent.append("".join(app.take_session_output(session)))
+        process = FakeProcess()
+        session = {'channel': FakeChannel(1), 'prompt_re': re.compile(r"^> "), 'send_output': send_output}
+        app.open_session(session, process)
+        app.queue_session_input(session, 1, [b"ping 1\n", b"ping 2\n"])
+        await asyncio.sleep(0.05)
+        assert process.written == b"ping 1\nping 2\n"
+        process.output.put_nowait(b"pong 1\n> \xff\xf9")
+        await asyncio.sleep(0.1)
+        assert sent == []
+        process.output.put_nowait(b"pong 2\n> \xff\xf9")
+        await asyncio.sleep(0.1)
+        assert sent == ["pong 1\n> pong 2\n> "]
+        app.stop_session_process(session)
+    asyncio.run(run())
+
+
+def make_if_app(monkeypatch, tmp_path):
+    monkeypatch.setattr(discordbot, "if_saves_path", str(tmp_path / "saves"))
+    monkeypatch.setattr(discordbot, "if_games_path", str(tmp_path))
+    (tmp_path / "game").write_text("")
+    app = make_app()
+    app.game_sessions, app.if_sessions, app.if_locks, app.trigger_matchers = {}, {}, {}, {}
+    app.save_settings = lambda: None
+    app.started = []
+    async def start_session_process(session, args, stderr=None):
+        await asyncio.sleep(0.01)
+        app.started.append(args)
+        app.open_session(session, FakeProcess())
+    app.start_session_process = start_session_process
+    return app
+
+
+def if_message(rm, content):
+    return types.SimpleNamespace(channel=rm, content=content, author=types.SimpleNamespace(id=5))
+
+
+def test_if_concurrent_resume_starts_one_game(monkeypatch, tmp_path):
+    async def run():
+        app = make_if_app(monkeypatch, tmp_path)
+        rm = FakeChannel(1)
+        app.bot_settings['if_saves']["1"] = "game"
+        await asyncio.gather(app.send_if_command(if_message(rm, "%if look")),
+                             app.send_if_command(if_message(rm, "%if north")))
+        assert len(app.started) == 1 and "-r" in app.started[0]
+        assert rm.sent == ["Resuming IF game."]
+        await asyncio.sleep(0.01)
+        assert app.if_sessions[1]['sp'].written == b"look\nnorth\n"
+        app.stop_session_process(app.if_sessions[1])
+    asyncio.run(run())
+
+
+def test_if_ended_game_does_not_resume_its_old_save(monkeypatch, tmp_path):
+    async def run():
+        app = make_if_app(monkeypatch, tmp_path)
+        rm = FakeChannel(1)
+        app.bot_settings['if_saves']["1"] = "game"
+        await app.send_if_command(if_message(rm, "%if quit"))
+        session = app.if_sessions[1]
+        session['sp'].output.put_nowait(b"")
+        await asyncio.sleep(0.01)
+        # %ifstart replaces the ended game and forgets the save it came from.
+        await app.start_if(if_message(rm, "%ifstart game"))
+        assert rm.sent[-1] == "Starting IF game."
+        assert app.bot_settings['if_saves'] == {} and len(app.started) == 2
+        assert "-r" not in app.started[1]
+        # Evicting an ended game forgets its save as well.
+        app.bot_settings['if_saves']["1"] = "game"
+        app.if_sessions[1]['sp'].output.put_nowait(b"")
+        await asyncio.sleep(0.01)
+        assert await app.evict_if_session(app.if_sessions[1])
+        assert app.bot_settings['if_saves'] == {} and not app.if_sessions
+        await app.send_if_command(if_message(rm, "%if look"))
+        assert rm.sent[-1] == "No IF session found for this channel. Use ifstart."
+    asyncio.run(run())